@@ -1,12 +1,15 @@
 """
 Question Answering API Routes with Enhanced Processing
 """
+import re
 import time
 import uuid
+import asyncio
 import logging
-from typing import List, Optional
+from typing import List, Optional, Dict, Tuple, Union
 from fastapi import APIRouter, HTTPException, Query, status, UploadFile, File
-import json
+import ijson
+import numpy as np
 
 from app.models.question import (
     Question,
@@ -19,10 +22,31 @@ from app.models.question import (
 from app.services.vector_store import vector_store
 from app.services.gemini_service import gemini_service
 from app.services.answer_processor import answer_processor
+from app.config import settings
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/questions", tags=["questions"])
 
+# Question type keyword patterns (matched against lowercased text), combined
+# into one alternation so detection is a single scan of the question
+_QUESTION_TYPE_PATTERNS = {
+    'true_false': ['evet/hayir', 'doğru/yanlış', 'true/false'],
+    'multiple_choice': ['çoktan seçmeli', 'multiple choice'],
+    'short_answer': ['kaç', 'ne zaman', 'hangi yıl', 'kim'],
+    'option_a': ['a)'],
+    'option_b': ['b)'],
+}
+_QUESTION_TYPE_RE = re.compile('|'.join(
+    f"(?P<{name}>{'|'.join(map(re.escape, patterns))})"
+    for name, patterns in _QUESTION_TYPE_PATTERNS.items()
+))
+
+# Multiple choice option lines: "A) text", "B) text", ...
+_MC_OPTION_RE = re.compile(r'^[^\S\n]*([A-Z])\)[^\S\n]*(.+)', re.MULTILINE)
+
+# Selected option in answers: "Cevap: A" or "Answer: B"
+_SELECTED_OPTION_RE = re.compile(r'(?:Cevap|Answer):\s*([A-Za-z0-9]+)', re.IGNORECASE)
+
 
 @router.post("/process", response_model=QAResult)
 async def process_questions(request: ProcessQuestionsRequest):
@@ -37,26 +61,25 @@ async def process_questions(request: ProcessQuestionsRequest):
     batch_id = str(uuid.uuid4())
     start_time = time.time()
 
-    results = []
-    completed = 0
-    failed = 0
-
     logger.info(f"Processing batch {batch_id}: {len(request.questions)} questions")
 
-    for question in request.questions:
-        try:
-            answer = await _process_single_question(
-                question=question,
-                top_k=request.top_k,
-                min_relevance=request.min_relevance_score,
-                enable_verification=request.enable_verification
-            )
-            results.append(answer)
-            completed += 1
+    # Stage 1: embed all questions up front in batched calls
+    question_embeddings = await gemini_service.generate_cached_embeddings(
+        [q.text for q in request.questions]
+    )
+
+    # Run search and answer generation as overlapping pipeline stages
+    outcomes = await _run_question_pipeline(request, question_embeddings)
 
-        except Exception as e:
-            logger.error(f"Failed to process question {question.id}: {e}")
+    results = []
+    failed = 0
+    for question, outcome in zip(request.questions, outcomes):
+        if isinstance(outcome, Exception):
+            logger.error(f"Failed to process question {question.id}: {outcome}")
             failed += 1
+        else:
+            results.append(outcome)
+    completed = len(results)
 
     total_time = time.time() - start_time
 
@@ -65,7 +88,8 @@ async def process_questions(request: ProcessQuestionsRequest):
         f"{total_time:.2f}s total"
     )
 
-    return QAResult(
+    # Response models are built from trusted internal data, skip validation
+    return QAResult.model_construct(
         batch_id=batch_id,
         total_questions=len(request.questions),
         completed=completed,
@@ -100,8 +124,11 @@ async def ask_single_question(
             type=question_type
         )
 
+        question_embeddings = await gemini_service.generate_cached_embeddings([q.text])
+
         answer = await _process_single_question(
             question=q,
+            question_embedding=question_embeddings[0],
             top_k=top_k,
             enable_verification=enable_verification
         )
@@ -126,18 +153,18 @@ async def upload_questions_json(file: UploadFile = File(...)):
         )
 
     try:
-        content = await file.read()
-        data = json.loads(content)
-
-        if 'questions' not in data:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="JSON must contain 'questions' array"
-            )
+        # Stream-parse the upload so the raw file is never held in memory
+        reader = _LimitedUploadReader(file, settings.max_json_upload_size)
 
         # Parse questions with auto type detection
         questions = []
-        for q_data in data['questions']:
+        async for q_data in ijson.items(reader, 'questions.item', use_float=True):
+            if len(questions) >= settings.max_questions_per_upload:
+                raise HTTPException(
+                    status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                    detail=f"Too many questions. Max: {settings.max_questions_per_upload}"
+                )
+
             # Auto-detect type from text
             question_text = q_data.get('text', '')
             question_type = _detect_question_type(question_text)
@@ -156,6 +183,12 @@ async def upload_questions_json(file: UploadFile = File(...)):
             )
             questions.append(q)
 
+        if not questions:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="JSON must contain 'questions' array"
+            )
+
         logger.info(f"Loaded {len(questions)} questions from JSON with auto-detected types")
 
         # Process questions
@@ -164,7 +197,9 @@ async def upload_questions_json(file: UploadFile = File(...)):
 
         return result
 
-    except json.JSONDecodeError as e:
+    except HTTPException:
+        raise
+    except ijson.JSONError as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"Invalid JSON: {str(e)}"
@@ -177,21 +212,44 @@ async def upload_questions_json(file: UploadFile = File(...)):
         )
 
 
+class _LimitedUploadReader:
+    """Async file-like wrapper around an upload that enforces a byte limit."""
+
+    def __init__(self, file: UploadFile, max_bytes: int):
+        self._file = file
+        self._max_bytes = max_bytes
+        self._bytes_read = 0
+
+    async def read(self, size: int = -1) -> bytes:
+        data = await self._file.read(size)
+        self._bytes_read += len(data)
+
+        if self._bytes_read > self._max_bytes:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"File too large. Max size: {self._max_bytes} bytes"
+            )
+
+        return data
+
+
 def _detect_question_type(text: str) -> QuestionType:
     """Auto-detect question type from text."""
     text_lower = text.lower()
 
-    # True/False detection
-    if any(pattern in text_lower for pattern in ['evet/hayir', 'doğru/yanlış', 'true/false']):
-        return QuestionType.TRUE_FALSE
+    found = set()
+    for match in _QUESTION_TYPE_RE.finditer(text_lower):
+        found.add(match.lastgroup)
+        # True/False has the highest priority, no need to scan further
+        if match.lastgroup == 'true_false':
+            return QuestionType.TRUE_FALSE
 
     # Multiple choice detection
-    if any(pattern in text_lower for pattern in ['çoktan seçmeli', 'multiple choice']) or \
-            ('a)' in text_lower and 'b)' in text_lower):
+    if 'multiple_choice' in found or {'option_a', 'option_b'} <= found:
         return QuestionType.MULTIPLE_CHOICE
 
     # Short answer detection (look for keywords)
-    if any(pattern in text_lower for pattern in ['kaç', 'ne zaman', 'hangi yıl', 'kim']):
+    if 'short_answer' in found:
         return QuestionType.SHORT_ANSWER
 
     # Default to open-ended
@@ -202,18 +260,13 @@ def _parse_multiple_choice_options(text: str) -> List:
     """Parse multiple choice options from question text."""
     from app.models.question import MultipleChoiceOption
 
-    # Find options (A), B), C), D) etc.
-    import re
+    # Find options (A), B), C), D) etc. - one match per line
     options = []
 
-    # Split by newlines and look for patterns
-    lines = text.split('\n')
-    for line in lines:
-        # Match: A) text, B) text, etc.
-        match = re.match(r'^([A-Z])\)\s*(.+)', line.strip())
-        if match:
-            option_id = match.group(1)
-            option_text = match.group(2).strip()
+    for match in _MC_OPTION_RE.finditer(text):
+        option_id = match.group(1)
+        option_text = match.group(2).strip()
+        if option_text:
             options.append(MultipleChoiceOption(
                 id=option_id,
                 text=option_text
@@ -222,9 +275,86 @@ def _parse_multiple_choice_options(text: str) -> List:
     return options if options else None
 
 
+async def _run_question_pipeline(
+    request: ProcessQuestionsRequest,
+    question_embeddings: np.ndarray
+) -> List[Union[Answer, Exception]]:
+    """
+    Run the search and answer stages of a batch as a staged async pipeline.
+
+    Bounded queues connect the stages so a question's search can overlap with
+    another question's answer generation. Each stage has its own worker
+    count; results are stored by input position to preserve order.
+
+    Returns:
+        List aligned with `request.questions` holding an Answer or the
+        exception that failed that question
+    """
+    search_workers = settings.pipeline_search_workers
+    answer_workers = settings.max_concurrent_questions
+
+    search_queue: asyncio.Queue = asyncio.Queue(maxsize=search_workers * 2)
+    answer_queue: asyncio.Queue = asyncio.Queue(maxsize=answer_workers * 2)
+    outcomes: List[Union[Answer, Exception, None]] = [None] * len(request.questions)
+
+    async def search_worker():
+        while (item := await search_queue.get()) is not None:
+            position, question, embedding, start_time = item
+            try:
+                chunks = await _retrieve_chunks(
+                    question=question,
+                    question_embedding=embedding,
+                    top_k=request.top_k,
+                    document_ids=request.document_ids,
+                    min_relevance=request.min_relevance_score
+                )
+            except Exception as e:
+                outcomes[position] = e
+                continue
+            await answer_queue.put((position, question, chunks, start_time))
+
+    async def answer_worker():
+        while (item := await answer_queue.get()) is not None:
+            position, question, chunks, start_time = item
+            try:
+                outcomes[position] = await _answer_from_chunks(
+                    question=question,
+                    relevant_chunks=chunks,
+                    enable_verification=request.enable_verification,
+                    start_time=start_time
+                )
+            except Exception as e:
+                outcomes[position] = e
+
+    search_tasks = [asyncio.create_task(search_worker()) for _ in range(search_workers)]
+    answer_tasks = [asyncio.create_task(answer_worker()) for _ in range(answer_workers)]
+
+    try:
+        for position, (question, embedding) in enumerate(
+            zip(request.questions, question_embeddings)
+        ):
+            await search_queue.put((position, question, embedding, time.time()))
+
+        # One sentinel per worker shuts each stage down once it has drained
+        for _ in search_tasks:
+            await search_queue.put(None)
+        await asyncio.gather(*search_tasks)
+
+        for _ in answer_tasks:
+            await answer_queue.put(None)
+        await asyncio.gather(*answer_tasks)
+    finally:
+        for task in search_tasks + answer_tasks:
+            task.cancel()
+
+    return outcomes
+
+
 async def _process_single_question(
     question: Question,
+    question_embedding: np.ndarray,
     top_k: int = 5,
+    document_ids: Optional[List[str]] = None,
     min_relevance: float = 0.5,
     enable_verification: bool = True
 ) -> Answer:
@@ -232,7 +362,7 @@ async def _process_single_question(
     Process a single question with full pipeline.
 
     Pipeline:
-    1. Generate question embedding
+    1. Use the precomputed question embedding
     2. Retrieve relevant chunks from vector store
     3. Generate answer with Gemini
     4. Extract and verify sources
@@ -240,29 +370,49 @@ async def _process_single_question(
     """
     start_time = time.time()
 
-    # Step 1: Generate embedding
-    question_embeddings = await gemini_service.generate_embeddings([question.text])
-    question_embedding = question_embeddings[0]
+    relevant_chunks = await _retrieve_chunks(
+        question=question,
+        question_embedding=question_embedding,
+        top_k=top_k,
+        document_ids=document_ids,
+        min_relevance=min_relevance
+    )
+
+    return await _answer_from_chunks(
+        question=question,
+        relevant_chunks=relevant_chunks,
+        enable_verification=enable_verification,
+        start_time=start_time
+    )
+
 
+async def _retrieve_chunks(
+    question: Question,
+    question_embedding: np.ndarray,
+    top_k: int = 5,
+    document_ids: Optional[List[str]] = None,
+    min_relevance: float = 0.5
+) -> List[Dict]:
+    """
+    Retrieve the chunks used as answer context for a question.
+
+    Returns:
+        Chunks passing `min_relevance` (at least the top 2 results), or an
+        empty list when the search found nothing
+    """
     # Step 2: Search vector store (FIXED: n_results instead of top_k)
-    search_results = vector_store.search(
+    # document_ids is applied as a metadata filter inside the ANN query.
+    # ChromaDB calls are blocking, so run them off the event loop.
+    search_results = await asyncio.to_thread(
+        vector_store.search,
         query_embedding=question_embedding,
-        n_results=top_k  # <-- DÜZELTME: top_k -> n_results
+        n_results=top_k,  # <-- DÜZELTME: top_k -> n_results
+        document_ids=document_ids
     )
 
     if not search_results:
         logger.warning(f"No relevant chunks found for question: {question.id}")
-        return Answer(
-            question_id=question.id,
-            question_text=question.text,
-            question_type=question.type,
-            answer="Üzgünüm, bu soruyla ilgili yüklenen belgelerde bilgi bulamadım.",
-            sources=[],
-            confidence_score=0.0,
-            verification_status="unverified",
-            processing_time=time.time() - start_time,
-            model_used=gemini_service.model.model_name
-        )
+        return []
 
     # Filter by relevance
     relevant_chunks = [
@@ -274,6 +424,33 @@ async def _process_single_question(
         relevant_chunks = search_results[:2]  # At least use top 2
 
     logger.info(f"Retrieved {len(relevant_chunks)} relevant chunks")
+    return relevant_chunks
+
+
+async def _answer_from_chunks(
+    question: Question,
+    relevant_chunks: List[Dict],
+    enable_verification: bool,
+    start_time: float
+) -> Answer:
+    """
+    Generate, verify and score the answer for retrieved chunks.
+
+    Only answer generation calls Gemini; source extraction, verification and
+    confidence scoring are local operations on the generated text.
+    """
+    if not relevant_chunks:
+        return Answer.model_construct(
+            question_id=question.id,
+            question_text=question.text,
+            question_type=question.type,
+            answer="Üzgünüm, bu soruyla ilgili yüklenen belgelerde bilgi bulamadım.",
+            sources=[],
+            confidence_score=0.0,
+            verification_status="unverified",
+            processing_time=time.time() - start_time,
+            model_used=gemini_service.model.model_name
+        )
 
     # Step 3: Generate answer
     answer_text, reasoning_steps = await gemini_service.answer_question(
@@ -283,35 +460,30 @@ async def _process_single_question(
         options=question.options
     )
 
-    # Step 4: Extract and verify sources
+    # Step 4: Extract and verify sources (CPU-bound, keep it off the event loop)
     if enable_verification:
-        sources = answer_processor.extract_quotes_from_answer(
-            answer=answer_text,
-            chunks=relevant_chunks
-        )
-
-        verification_status = answer_processor.verify_sources(sources)
-
-        confidence_score = answer_processor.calculate_answer_confidence(
-            answer=answer_text,
-            sources=sources,
-            question_type=question.type
+        sources, verification_status, confidence_score = await asyncio.to_thread(
+            _verify_answer,
+            answer_text,
+            relevant_chunks,
+            question.type
         )
     else:
         # Fallback: Create basic sources from top chunks
-        sources = [
-            SourceEvidence(
+        sources = []
+        for chunk in relevant_chunks[:3]:
+            # Slice the chunk once; the quote is a prefix of the context
+            context = chunk['text'][:300]
+            sources.append(SourceEvidence.model_construct(
                 chunk_id=chunk['chunk_id'],
                 document_id=chunk['document_id'],
-                exact_quote=chunk['text'][:200],
-                context=chunk['text'][:300],
+                exact_quote=context[:200],
+                context=context,
                 page_number=chunk.get('page_number'),
                 relevance_score=chunk['relevance_score'],
                 confidence_score=chunk['relevance_score'],
                 match_type="inference"
-            )
-            for chunk in relevant_chunks[:3]
-        ]
+            ))
         verification_status = "unverified"
         confidence_score = 0.7
 
@@ -330,7 +502,7 @@ async def _process_single_question(
         f"time={processing_time:.2f}s"
     )
 
-    return Answer(
+    return Answer.model_construct(
         question_id=question.id,
         question_text=question.text,
         question_type=question.type,
@@ -345,6 +517,33 @@ async def _process_single_question(
     )
 
 
+def _verify_answer(
+    answer_text: str,
+    chunks: List[Dict],
+    question_type: QuestionType
+) -> Tuple[List[SourceEvidence], str, float]:
+    """
+    Extract sources from an answer, then verify and score them.
+
+    Returns:
+        Tuple of (sources, verification status, confidence score)
+    """
+    sources = answer_processor.extract_quotes_from_answer(
+        answer=answer_text,
+        chunks=chunks
+    )
+
+    verification_status = answer_processor.verify_sources(sources)
+
+    confidence_score = answer_processor.calculate_answer_confidence(
+        answer=answer_text,
+        sources=sources,
+        question_type=question_type
+    )
+
+    return sources, verification_status, confidence_score
+
+
 def _extract_selected_option(
     answer: str,
     options: Optional[List]
@@ -354,8 +553,7 @@ def _extract_selected_option(
         return None
 
     # Look for patterns like "Cevap: A" or "Answer: B"
-    import re
-    match = re.search(r'(?:Cevap|Answer):\s*([A-Za-z0-9]+)', answer, re.IGNORECASE)
+    match = _SELECTED_OPTION_RE.search(answer)
     if match:
         selected_id = match.group(1).upper()
         # Verify it's a valid option
@@ -2,10 +2,11 @@ from fastapi import APIRouter, UploadFile, File, HTTPException, status
 from typing import List
 import uuid
 import time
+import asyncio
 import logging
 
 from app.models.document import DocumentUploadResponse, DocumentProcessingResult, DocumentStatus
-from app.services.document_processor import document_processor
+from app.services.document_processor import document_processor, FileTooLargeError
 from app.services.vector_store import vector_store
 from app.services.gemini_service import gemini_service
 from app.config import settings
@@ -20,8 +21,8 @@ async def upload_document(file: UploadFile = File(...)):
     Upload and process a document.
 
     Steps:
-    1. Validate file type and size
-    2. Save file to disk
+    1. Validate file type
+    2. Stream file to disk (size-checked)
     3. Extract and chunk text
     4. Generate embeddings
     5. Store in ChromaDB
@@ -35,22 +36,20 @@ async def upload_document(file: UploadFile = File(...)):
                 detail=f"Unsupported file type. Allowed: {settings.allowed_extensions}"
             )
 
-        # Read file content
-        content = await file.read()
-
-        # Validate file size
-        if len(content) > settings.max_file_size:
+        # Stream file to disk, enforcing the size limit while reading
+        try:
+            file_path = await document_processor.save_uploaded_file(
+                file, file.filename, settings.max_file_size
+            )
+        except FileTooLargeError as e:
             raise HTTPException(
                 status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
-                detail=f"File too large. Max size: {settings.max_file_size} bytes"
+                detail=str(e)
             )
 
         # Generate document ID
         document_id = str(uuid.uuid4())
 
-        # Save file
-        file_path = document_processor.save_uploaded_file(content, file.filename)
-
         logger.info(f"Processing document: {document_id} - {file.filename}")
 
         # Process document in background (for now, synchronously)
@@ -60,8 +59,17 @@ async def upload_document(file: UploadFile = File(...)):
         chunk_texts = [chunk.text for chunk in chunks]
         embeddings = await gemini_service.generate_embeddings_batch(chunk_texts)
 
+        # Zero rows are texts the API never embedded; storing them would leave
+        # chunks that can never be retrieved
+        failed = int((~embeddings.any(axis=1)).sum())
+        if failed:
+            raise HTTPException(
+                status_code=status.HTTP_502_BAD_GATEWAY,
+                detail=f"Embedding generation failed for {failed} of {len(chunks)} chunks"
+            )
+
         # Store in ChromaDB
-        vector_store.add_chunks(chunks, embeddings)
+        await asyncio.to_thread(vector_store.add_chunks, chunks, embeddings)
 
         return DocumentUploadResponse(
             document_id=document_id,
@@ -71,6 +79,8 @@ async def upload_document(file: UploadFile = File(...)):
             metadata=metadata
         )
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error uploading document: {e}")
         raise HTTPException(
@@ -83,7 +93,7 @@ async def upload_document(file: UploadFile = File(...)):
 async def get_stats():
     """Get statistics about stored documents."""
     try:
-        stats = vector_store.get_collection_stats()
+        stats = await asyncio.to_thread(vector_store.get_collection_stats)
         return stats
     except Exception as e:
         logger.error(f"Error getting stats: {e}")
@@ -98,7 +108,7 @@ async def delete_document(document_id: str):
     """Delete a document and its chunks."""
     try:
         # Delete from vector store
-        success = vector_store.delete_by_document_id(document_id)
+        success = await asyncio.to_thread(vector_store.delete_by_document_id, document_id)
 
         if not success:
             raise HTTPException(
@@ -121,25 +131,7 @@ async def delete_document(document_id: str):
 async def list_documents():
     """List all uploaded documents with metadata."""
     try:
-        stats = vector_store.get_collection_stats()
-
-        # Get unique document IDs from ChromaDB
-        collection = vector_store.collection
-        results = collection.get()
-
-        docs = {}
-        for metadata in results['metadatas']:
-            doc_id = metadata.get('document_id')
-            if doc_id and doc_id not in docs:
-                docs[doc_id] = {
-                    'document_id': doc_id,
-                    'chunk_count': 0,
-                    'first_seen': metadata.get('upload_date', 'Unknown')
-                }
-            if doc_id:
-                docs[doc_id]['chunk_count'] += 1
-
-        return list(docs.values())
+        return await asyncio.to_thread(vector_store.list_documents)
     except Exception as e:
         logger.error(f"Error listing documents: {e}")
         raise HTTPException(
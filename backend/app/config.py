@@ -11,6 +11,7 @@ class Settings(BaseSettings):
     version: str = "0.1.0"
     api_prefix: str = "/api/v1"
     debug: bool = True
+    thread_pool_workers: int = 16  # Default executor for offloaded blocking work
 
     # CORS Settings
     cors_origins: List[str] = ["http://localhost:3000", "http://localhost:5173"]
@@ -19,18 +20,46 @@ class Settings(BaseSettings):
     gemini_api_key: str = ""  # Will be loaded from .env
     gemini_model: str = "gemini-3-flash-preview"
     gemini_embedding_model: str = "models/text-embedding-004"
+    # Lower values shrink stored vectors and search bandwidth; changing this
+    # requires re-indexing existing documents
+    embedding_dimensions: int = 768
+    connection_check_ttl: float = 60.0  # Seconds a successful connection test is reused
 
     # ChromaDB Settings
     chroma_persist_directory: str = "./chroma_db"
     chroma_collection_name: str = "documents"
+    # HNSW index parameters (applied when the collection is first created).
+    # Embeddings are L2-normalized, so inner product equals cosine similarity.
+    chroma_hnsw_space: str = "ip"
+    chroma_hnsw_m: int = 16
+    chroma_hnsw_construction_ef: int = 64
+    chroma_hnsw_search_ef: int = 40
+    document_list_cache_ttl: float = 30.0  # Seconds
+    chroma_add_batch_size: int = 512  # Chunks per collection.add call
+    chroma_sqlite_wal: bool = True  # Disable on filesystems without shared-memory support
 
     # Document Processing
     chunk_size: int = 500
     chunk_overlap: int = 50
     max_file_size: int = 10 * 1024 * 1024  # 10MB
+    chunk_cache_size: int = 64  # Documents whose chunks are kept for re-uploads
+
+    # Question Processing
+    max_concurrent_questions: int = 8  # Answer-generation workers per batch
+    pipeline_search_workers: int = 4  # Vector search workers per batch
+    embedding_batch_size: int = 100  # Texts per batch embedding request (API max 100)
+    embedding_concurrency: int = 16  # Concurrent embedding API calls
+    max_questions_per_upload: int = 1000
+    embedding_cache_size: int = 10_000  # Cached question embeddings
+    embedding_cache_ttl: float = 86400.0  # Seconds
+    answer_cache_size: int = 512  # Cached generated answers
+    answer_cache_ttl: float = 3600.0  # Seconds
+    max_json_upload_size: int = 5 * 1024 * 1024  # 5MB
+    enable_fuzzy_matching: bool = True  # Fuzzy quote alignment during verification
 
     # Upload Settings
     upload_directory: str = "./uploads"
+    upload_chunk_size: int = 1024 * 1024  # Bytes copied per streamed upload block
     allowed_extensions: List[str] = [".pdf", ".docx", ".txt"]
 
     # Pydantic v2 configuration
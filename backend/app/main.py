@@ -1,9 +1,14 @@
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
+import asyncio
 import logging
 
 from app.config import settings
 from app.api.routes import upload, query
+from app.services.gemini_service import gemini_service
 
 # Configure logging
 logging.basicConfig(
@@ -13,13 +18,34 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Application startup and shutdown."""
+    # Size the default executor used by asyncio.to_thread for blocking work
+    executor = ThreadPoolExecutor(max_workers=settings.thread_pool_workers)
+    asyncio.get_running_loop().set_default_executor(executor)
+    logger.info(f"Default executor sized to {settings.thread_pool_workers} workers")
+
+    # Open the shared async Gemini client connection in the background; the
+    # SDK can retry for up to a minute when Gemini is unreachable
+    warmup = asyncio.create_task(gemini_service.test_connection())
+
+    yield
+
+    warmup.cancel()
+    executor.shutdown(wait=False)
+
+
 # Create FastAPI app
 app = FastAPI(
     title=settings.app_name,
     version=settings.version,
     description="Querova - AI-Powered Document Q&A System",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # Configure CORS
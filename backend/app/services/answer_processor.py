@@ -7,12 +7,28 @@ Answer Quality Enhancement & Source Verification Service
 import re
 import logging
 from typing import List, Tuple, Dict, Optional  # Optional ekledik
-from difflib import SequenceMatcher
 
+from rapidfuzz import fuzz, process
+
+from app.config import settings
 from app.models.question import SourceEvidence, QuestionType
 
 logger = logging.getLogger(__name__)
 
+# Citation markers such as [Kaynak 1] or [Source 2]
+_CITATION_RE = re.compile(r'\[(?:Kaynak|Source)\s+(\d+)\]', re.IGNORECASE)
+
+
+def _fold_case(text: str) -> str:
+    """
+    Lowercase text without changing its length.
+
+    'İ' is the only character whose lower() form is two code points, so it is
+    mapped to 'i' first. This keeps offsets in the folded text valid for the
+    original text.
+    """
+    return text.replace('İ', 'i').lower()
+
 
 class AnswerProcessor:
     """
@@ -28,6 +44,8 @@ class AnswerProcessor:
     def __init__(self):
         self.min_quote_length = 10
         self.min_match_ratio = 0.85
+        # Fuzzy alignment is the costly part of verification; allow turning it off
+        self.enable_fuzzy = settings.enable_fuzzy_matching
         logger.info("AnswerProcessor initialized")
 
     def extract_quotes_from_answer(
@@ -42,11 +60,11 @@ class AnswerProcessor:
         sources = []
 
         # Strategy 1: Look for [Kaynak X] citations
-        citation_pattern = r'\[(?:Kaynak|Source)\s+(\d+)\]'
-        citations = list(re.finditer(citation_pattern, answer, re.IGNORECASE))
+        citations = list(_CITATION_RE.finditer(answer))
 
         if citations:
             logger.info(f"Found {len(citations)} citation markers")
+            seen_ids = set()
             for match in citations:
                 citation_num = int(match.group(1))
                 chunk_idx = citation_num - 1
@@ -56,31 +74,36 @@ class AnswerProcessor:
 
                 chunk = chunks[chunk_idx]
 
-                # Create source evidence
-                source = SourceEvidence(
+                # Avoid duplicates
+                if chunk['chunk_id'] in seen_ids:
+                    continue
+                seen_ids.add(chunk['chunk_id'])
+
+                # Create source evidence (fields come straight from the
+                # vector store, so validation is skipped)
+                context = chunk['text'][:500]
+                source = SourceEvidence.model_construct(
                     chunk_id=chunk['chunk_id'],
                     document_id=chunk['document_id'],
-                    exact_quote=chunk['text'][:300],  # First 300 chars
-                    context=chunk['text'][:500],
+                    exact_quote=context[:300],  # First 300 chars
+                    context=context,
                     page_number=chunk.get('page_number'),
                     relevance_score=chunk['relevance_score'],
                     confidence_score=0.9,  # High confidence for cited sources
                     match_type="exact"
                 )
-
-                # Avoid duplicates
-                if not any(s.chunk_id == source.chunk_id for s in sources):
-                    sources.append(source)
+                sources.append(source)
 
         # Strategy 2: If no citations, use top chunks as sources
         if not sources:
             logger.info("No citations found, using top chunks as sources")
             for i, chunk in enumerate(chunks[:3]):  # Top 3 chunks
-                source = SourceEvidence(
+                context = chunk['text'][:500]
+                source = SourceEvidence.model_construct(
                     chunk_id=chunk['chunk_id'],
                     document_id=chunk['document_id'],
-                    exact_quote=chunk['text'][:300],
-                    context=chunk['text'][:500],
+                    exact_quote=context[:300],
+                    context=context,
                     page_number=chunk.get('page_number'),
                     relevance_score=chunk['relevance_score'],
                     confidence_score=chunk['relevance_score'],
@@ -91,43 +114,74 @@ class AnswerProcessor:
         logger.info(f"Extracted {len(sources)} verified sources")
         return sources
 
+    @property
+    def fuzzy_active(self) -> bool:
+        """Whether fuzzy matching can produce anything beyond exact matches."""
+        return self.enable_fuzzy and self.min_match_ratio < 1.0
+
+    @staticmethod
+    def _chunk_lower(chunk: Dict) -> str:
+        """
+        Get the case-folded text of a retrieved chunk.
+
+        Computed on first use and memoized on the chunk dict as `text_lower`,
+        so every matching path shares one copy per chunk.
+        """
+        chunk_lower = chunk.get('text_lower')
+        if chunk_lower is None:
+            chunk_lower = chunk['text_lower'] = _fold_case(chunk['text'])
+        return chunk_lower
+
     def _extract_quote_context(
             self,
             answer: str,
             citation_pos: int,
-            chunk_text: str
+            chunk_text: str,
+            chunk_lower: Optional[str] = None
     ) -> Optional[Tuple[str, str, str, float]]:
         """
         Extract the relevant quote and context around a citation.
 
+        Args:
+            answer: Full answer text
+            citation_pos: Position of the citation marker in the answer
+            chunk_text: Text of the cited chunk
+            chunk_lower: Case-folded chunk text, if the caller already has it
+
         Returns:
             Tuple of (exact_quote, context, match_type, confidence_score)
         """
-        # Get sentence containing citation
-        sentences_before = answer[:citation_pos].split('.')
-        sentence = sentences_before[-1] if sentences_before else ""
+        # Get sentence containing citation (text after the last '.' before it)
+        sentence_start = answer.rfind('.', 0, citation_pos) + 1
+        sentence = answer[sentence_start:citation_pos]
 
         # Clean sentence
         sentence = sentence.strip()
         if len(sentence) < self.min_quote_length:
             return None
 
+        if chunk_lower is None:
+            chunk_lower = _fold_case(chunk_text)
+        sentence_lower = _fold_case(sentence)
+
         # Try exact match
-        if sentence.lower() in chunk_text.lower():
-            start_idx = chunk_text.lower().index(sentence.lower())
+        start_idx = chunk_lower.find(sentence_lower)
+        if start_idx != -1:
             context_start = max(0, start_idx - 100)
             context_end = min(len(chunk_text), start_idx + len(sentence) + 100)
             context = chunk_text[context_start:context_end]
 
             return (sentence, context, "exact", 1.0)
 
+        if not self.fuzzy_active:
+            return None
+
         # Try fuzzy match
-        best_match = self._find_best_match(sentence, chunk_text)
+        best_match = self._find_best_match(sentence, chunk_text, chunk_lower)
         if best_match:
-            match_text, match_ratio = best_match
+            match_text, match_ratio, start_idx = best_match
             if match_ratio >= self.min_match_ratio:
                 # Extract context around match
-                start_idx = chunk_text.index(match_text)
                 context_start = max(0, start_idx - 100)
                 context_end = min(len(chunk_text), start_idx + len(match_text) + 100)
                 context = chunk_text[context_start:context_end]
@@ -140,36 +194,36 @@ class AnswerProcessor:
     def _find_best_match(
             self,
             query: str,
-            text: str
-    ) -> Optional[Tuple[str, float]]:
+            text: str,
+            text_lower: Optional[str] = None
+    ) -> Optional[Tuple[str, float, int]]:
         """
-        Find best matching substring in text using sliding window.
+        Find best matching substring in text using RapidFuzz partial alignment.
+
+        Args:
+            query: Text to look for
+            text: Text to search in
+            text_lower: Case-folded `text`, if the caller already has it
 
         Returns:
-            Tuple of (matched_text, similarity_ratio)
+            Tuple of (matched_text, similarity_ratio, start offset in text)
         """
-        words = text.split()
-        query_words = query.split()
-        query_len = len(query_words)
-
-        if query_len == 0 or len(words) == 0:
+        if not query.strip() or not text.strip():
             return None
 
-        best_match = None
-        best_ratio = 0.0
-
-        for i in range(len(words) - query_len + 1):
-            window = ' '.join(words[i:i + query_len])
-            ratio = SequenceMatcher(None, query.lower(), window.lower()).ratio()
-
-            if ratio > best_ratio:
-                best_ratio = ratio
-                best_match = window
-
-        if best_ratio >= self.min_match_ratio:
-            return (best_match, best_ratio)
+        alignment = fuzz.partial_ratio_alignment(
+            _fold_case(query),
+            text_lower if text_lower is not None else _fold_case(text),
+            score_cutoff=self.min_match_ratio * 100
+        )
+        if alignment is None:
+            return None
 
-        return None
+        return (
+            text[alignment.dest_start:alignment.dest_end],
+            alignment.score / 100,
+            alignment.dest_start
+        )
 
     def _fuzzy_match_to_chunks(
             self,
@@ -180,40 +234,59 @@ class AnswerProcessor:
         When no explicit citations, try to match answer content to chunks.
         """
         sources = []
-        sentences = [s.strip() for s in answer.split('.') if len(s.strip()) > 20]
+        if not self.fuzzy_active:
+            return sources
 
-        for chunk in chunks[:3]:  # Top 3 chunks
+        sentences = [s.strip() for s in answer.split('.') if len(s.strip()) > 20]
+        top_chunks = chunks[:3]  # Top 3 chunks
+
+        if not sentences or not top_chunks:
+            return sources
+
+        folded_sentences = [_fold_case(sentence) for sentence in sentences]
+        folded_chunks = [self._chunk_lower(chunk) for chunk in top_chunks]
+
+        # Score every (sentence, chunk) pair in one multithreaded C call;
+        # pairs below the match threshold score 0
+        scores = process.cdist(
+            folded_sentences,
+            folded_chunks,
+            scorer=fuzz.partial_ratio,
+            score_cutoff=self.min_match_ratio * 100,
+            workers=-1
+        )
+
+        for chunk_idx, chunk in enumerate(top_chunks):
+            # Use best matching sentence as quote
+            sentence_idx = int(scores[:, chunk_idx].argmax())
+            if scores[sentence_idx, chunk_idx] <= 0:
+                continue
+
+            # Align only the winning pair to locate the quote in the chunk
             chunk_text = chunk['text']
-            matched_sentences = []
-
-            for sentence in sentences:
-                best_match = self._find_best_match(sentence, chunk_text)
-                if best_match:
-                    matched_text, ratio = best_match
-                    if ratio >= 0.7:  # Lower threshold for fuzzy matching
-                        matched_sentences.append((matched_text, ratio))
-
-            if matched_sentences:
-                # Use best matching sentence as quote
-                best_sentence, confidence = max(matched_sentences, key=lambda x: x[1])
-
-                # Extract context
-                start_idx = chunk_text.index(best_sentence)
-                context_start = max(0, start_idx - 100)
-                context_end = min(len(chunk_text), start_idx + len(best_sentence) + 100)
-                context = chunk_text[context_start:context_end]
+            alignment = fuzz.partial_ratio_alignment(
+                folded_sentences[sentence_idx],
+                folded_chunks[chunk_idx]
+            )
+            best_sentence = chunk_text[alignment.dest_start:alignment.dest_end]
+            confidence = float(scores[sentence_idx, chunk_idx]) / 100
+
+            # Extract context
+            context_start = max(0, alignment.dest_start - 100)
+            context_end = min(len(chunk_text), alignment.dest_end + 100)
+            context = chunk_text[context_start:context_end]
 
-                source = SourceEvidence(
-                    chunk_id=chunk['chunk_id'],
-                    document_id=chunk['document_id'],
-                    exact_quote=best_sentence,
-                    context=context,
-                    page_number=chunk.get('page_number'),
-                    relevance_score=chunk['relevance_score'],
-                    confidence_score=confidence,
-                    match_type="inference"
-                )
-                sources.append(source)
+            source = SourceEvidence.model_construct(
+                chunk_id=chunk['chunk_id'],
+                document_id=chunk['document_id'],
+                exact_quote=best_sentence,
+                context=context,
+                page_number=chunk.get('page_number'),
+                relevance_score=chunk['relevance_score'],
+                confidence_score=confidence,
+                match_type="inference"
+            )
+            sources.append(source)
 
         return sources
 
@@ -235,19 +308,25 @@ class AnswerProcessor:
         if not sources:
             return 0.3  # Low confidence without sources
 
-        # Average source confidence
-        avg_source_confidence = sum(s.confidence_score for s in sources) / len(sources)
+        # Average source confidence (single pass)
+        total_confidence = 0.0
+        source_count = 0
+        for source in sources:
+            total_confidence += source.confidence_score
+            source_count += 1
+        avg_source_confidence = total_confidence / source_count
 
         # Number of sources (more is better, up to a point)
-        source_factor = min(len(sources) / 3, 1.0)
+        source_factor = min(source_count / 3, 1.0)
 
-        # Answer completeness (based on length)
-        length_factor = 1.0
-        if question_type == QuestionType.OPEN_ENDED:
-            if len(answer) < 50:
-                length_factor = 0.7
-            elif len(answer) > 500:
-                length_factor = 0.9
+        # Answer completeness (based on length, open-ended answers only)
+        answer_length = len(answer)
+        is_open_ended = question_type == QuestionType.OPEN_ENDED
+        length_factor = (
+            0.7 if is_open_ended and answer_length < 50
+            else 0.9 if is_open_ended and answer_length > 500
+            else 1.0
+        )
 
         # Combine factors
         confidence = (avg_source_confidence * 0.5 +
@@ -266,12 +345,18 @@ class AnswerProcessor:
         if not sources:
             return "unverified"
 
-        exact_matches = sum(1 for s in sources if s.match_type == "exact")
-        high_confidence = sum(1 for s in sources if s.confidence_score >= 0.9)
-
-        if exact_matches >= 2 or high_confidence >= 2:
-            return "verified"
-        elif exact_matches >= 1 or high_confidence >= 1:
+        # Single pass, stopping as soon as the "verified" threshold is reached
+        exact_matches = 0
+        high_confidence = 0
+        for source in sources:
+            if source.match_type == "exact":
+                exact_matches += 1
+            if source.confidence_score >= 0.9:
+                high_confidence += 1
+            if exact_matches >= 2 or high_confidence >= 2:
+                return "verified"
+
+        if exact_matches >= 1 or high_confidence >= 1:
             return "partial"
         else:
             return "unverified"
@@ -1,10 +1,20 @@
 import os
 import uuid
 import re
+import asyncio
+import bisect
+import hashlib
+import zipfile
+import posixpath
+from collections import OrderedDict
 from typing import List, Dict, Any, Tuple, Optional
 from pathlib import Path
+import aiofiles
+import numpy as np
 import fitz  # PyMuPDF
-from docx import Document
+from lxml import etree
+from charset_normalizer import from_bytes
+from fastapi import UploadFile
 import logging
 
 from app.config import settings
@@ -12,6 +22,46 @@ from app.models.document import DocumentChunk, DocumentMetadata
 
 logger = logging.getLogger(__name__)
 
+_BLANKLINE_RE = re.compile(r'\n\s*\n')
+
+# Code points str.isspace() treats as whitespace (all of them are <= U+3000)
+_WHITESPACE_CODEPOINTS = np.array(
+    [cp for cp in range(0x3001) if chr(cp).isspace()], dtype=np.uint32
+)
+
+# Plain-text extraction with ligatures expanded (e.g. "ﬁ" -> "fi")
+_PDF_TEXT_FLAGS = fitz.TEXTFLAGS_TEXT & ~fitz.TEXT_PRESERVE_LIGATURES
+
+# WordprocessingML element tags used by the streaming DOCX reader
+_W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+_W_P = _W_NS + 'p'
+_W_T = _W_NS + 't'
+_W_TAB = _W_NS + 'tab'
+_W_BREAKS = (_W_NS + 'br', _W_NS + 'cr')
+_W_TBL = _W_NS + 'tbl'
+_W_TR = _W_NS + 'tr'
+_W_TC = _W_NS + 'tc'
+# Subtrees whose text is skipped, as python-docx does: text box content (a
+# w:p nested inside the host w:p) and markup-compatibility fallbacks, which
+# repeat the preferred mc:Choice content for older readers
+_DOCX_SKIPPED_TAGS = frozenset((
+    _W_NS + 'txbxContent',
+    '{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback',
+))
+
+# Package relationships that point at the main document part (transitional
+# and strict OOXML)
+_DOCX_PACKAGE_RELS = '_rels/.rels'
+_DOCX_OFFICE_DOCUMENT_TYPES = frozenset((
+    'http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument',
+    'http://purl.oclc.org/ooxml/officeDocument/relationships/officeDocument',
+))
+_DOCX_DEFAULT_MAIN_PART = 'word/document.xml'
+
+
+class FileTooLargeError(ValueError):
+    """Raised when an uploaded file exceeds the configured size limit."""
+
 
 class DocumentProcessor:
     """
@@ -22,6 +72,7 @@ class DocumentProcessor:
     - Multi-format parsing
     - Semantic chunking with overlap
     - Metadata extraction (page numbers, positions)
+    - LRU cache of chunks for re-uploaded content
     - Error handling and logging
     """
 
@@ -30,6 +81,9 @@ class DocumentProcessor:
         self.chunk_overlap = settings.chunk_overlap
         self.upload_dir = Path(settings.upload_directory)
         self.upload_dir.mkdir(exist_ok=True)
+        # (content hash, type, chunk params) -> (page count, chunks); only
+        # touched on the event loop, so no locking is needed
+        self._chunk_cache: "OrderedDict[Tuple[str, str, int, int], Tuple[int, List[DocumentChunk]]]" = OrderedDict()
         logger.info(f"DocumentProcessor initialized: chunk_size={self.chunk_size}, overlap={self.chunk_overlap}")
 
     async def process_document(
@@ -57,25 +111,25 @@ class DocumentProcessor:
         logger.info(f"Processing document: {document_id}, type: {file_extension}")
 
         try:
-            # Extract text based on file type
-            if file_extension == '.pdf':
-                text, page_count = await self._extract_from_pdf(file_path)
-            elif file_extension == '.docx':
-                text, page_count = await self._extract_from_docx(file_path)
-            elif file_extension == '.txt':
-                text, page_count = await self._extract_from_txt(file_path)
-            else:
+            if file_extension not in ('.pdf', '.docx', '.txt'):
                 raise ValueError(f"Unsupported file type: {file_extension}")
 
-            # Validate extracted text
-            if not text or len(text.strip()) < 10:
-                raise ValueError("Document appears to be empty or too short")
-
-            # Create chunks
-            chunks = self._create_chunks(text, document_id)
+            content_hash = await asyncio.to_thread(self._hash_file, file_path)
+            cache_key = (content_hash, file_extension, self.chunk_size, self.chunk_overlap)
 
-            if not chunks:
-                raise ValueError("No chunks could be created from document")
+            cached = self._chunk_cache.get(cache_key)
+            if cached is not None:
+                self._chunk_cache.move_to_end(cache_key)
+                page_count, cached_chunks = cached
+                chunks = self._copy_chunks(cached_chunks, document_id)
+                logger.info(f"Reusing cached chunks for {document_id} (identical content)")
+            else:
+                page_count, chunks = await self._extract_and_chunk(
+                    file_path, file_extension, document_id
+                )
+                self._chunk_cache[cache_key] = (page_count, chunks)
+                while len(self._chunk_cache) > settings.chunk_cache_size:
+                    self._chunk_cache.popitem(last=False)
 
             # Create metadata
             metadata = DocumentMetadata(
@@ -97,7 +151,69 @@ class DocumentProcessor:
             logger.error(f"Failed to process document {document_id}: {str(e)}")
             raise
 
-    async def _extract_from_pdf(self, file_path: str) -> Tuple[str, int]:
+    async def _extract_and_chunk(
+            self,
+            file_path: str,
+            file_extension: str,
+            document_id: str
+    ) -> Tuple[int, List[DocumentChunk]]:
+        """
+        Extract text from a document and split it into chunks.
+
+        Args:
+            file_path: Path to the uploaded document
+            file_extension: Lower-cased file extension
+            document_id: Unique identifier for the document
+
+        Returns:
+            Tuple of (page count, list of document chunks)
+        """
+        # Extract text based on file type (page offsets exist for PDFs only)
+        page_starts = None
+        if file_extension == '.pdf':
+            text, page_count, page_starts = await self._extract_from_pdf(file_path)
+        elif file_extension == '.docx':
+            text, page_count = await self._extract_from_docx(file_path)
+        else:
+            text, page_count = await self._extract_from_txt(file_path)
+
+        # Validate extracted text
+        if not text or len(text.strip()) < 10:
+            raise ValueError("Document appears to be empty or too short")
+
+        # Create chunks
+        chunks = self._create_chunks(text, document_id, page_starts)
+
+        if not chunks:
+            raise ValueError("No chunks could be created from document")
+
+        return page_count, chunks
+
+    @staticmethod
+    def _hash_file(file_path: str) -> str:
+        """Hash file contents in blocks into a compact cache key."""
+        digest = hashlib.blake2b(digest_size=16)
+        with open(file_path, 'rb') as f:
+            while block := f.read(settings.upload_chunk_size):
+                digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    def _copy_chunks(chunks: List[DocumentChunk], document_id: str) -> List[DocumentChunk]:
+        """Copy cached chunks, re-keying them to a new document ID."""
+        return [
+            chunk.model_copy(update={
+                "chunk_id": f"{document_id}_chunk_{chunk.chunk_index}",
+                "document_id": document_id,
+                "metadata": dict(chunk.metadata)
+            })
+            for chunk in chunks
+        ]
+
+    async def _extract_from_pdf(
+            self,
+            file_path: str
+    ) -> Tuple[str, int, List[Tuple[int, int]]]:
         """
         Extract text from PDF file.
 
@@ -105,34 +221,53 @@ class DocumentProcessor:
             file_path: Path to PDF file
 
         Returns:
-            Tuple of (extracted text, page count)
+            Tuple of (extracted text, page count, page starts), where page
+            starts are (char offset, page number) pairs for non-empty pages
         """
         try:
-            doc = fitz.open(file_path)
-            page_count = len(doc)  # Get count BEFORE closing
+            # MuPDF decoding is blocking; run it on the thread pool
+            full_text, page_count, page_starts = await asyncio.to_thread(
+                self._read_pdf, file_path
+            )
+            logger.info(f"PDF extracted: {page_count} pages, {len(full_text)} characters")
+
+            return full_text, page_count, page_starts
+
+        except Exception as e:
+            logger.error(f"PDF extraction failed: {str(e)}")
+            raise
+
+    @staticmethod
+    def _read_pdf(file_path: str) -> Tuple[str, int, List[Tuple[int, int]]]:
+        """
+        Read all pages of a PDF synchronously.
+
+        PyMuPDF documents must not be shared across threads, so pages are
+        decoded sequentially inside a single worker thread. Instead of
+        embedding page markers in the text, the offset where each page
+        starts is recorded alongside it.
+        """
+        separator = "\n\n"
+
+        with fitz.open(file_path) as doc:
+            page_count = len(doc)
             text_parts = []
+            page_starts = []
+            offset = 0
 
             for page_num in range(page_count):
                 page = doc[page_num]
-                text = page.get_text()
+                text = page.get_text("text", flags=_PDF_TEXT_FLAGS)
 
                 # Clean up excessive whitespace
-                text = re.sub(r'\n\s*\n', '\n\n', text)
-                text = text.strip()
+                text = _BLANKLINE_RE.sub('\n\n', text).strip()
 
                 if text:  # Only add non-empty pages
-                    text_parts.append(f"[Page {page_num + 1}]\n{text}")
-
-            doc.close()
-
-            full_text = "\n\n".join(text_parts)
-            logger.info(f"PDF extracted: {page_count} pages, {len(full_text)} characters")
-
-            return full_text, page_count
+                    page_starts.append((offset, page_num + 1))
+                    text_parts.append(text)
+                    offset += len(text) + len(separator)
 
-        except Exception as e:
-            logger.error(f"PDF extraction failed: {str(e)}")
-            raise
+        return separator.join(text_parts), page_count, page_starts
 
     async def _extract_from_docx(self, file_path: str) -> Tuple[str, int]:
         """
@@ -145,23 +280,7 @@ class DocumentProcessor:
             Tuple of (extracted text, estimated page count)
         """
         try:
-            doc = Document(file_path)
-
-            # Extract paragraphs
-            paragraphs = []
-            for para in doc.paragraphs:
-                text = para.text.strip()
-                if text:
-                    paragraphs.append(text)
-
-            # Extract tables
-            for table in doc.tables:
-                for row in table.rows:
-                    row_text = ' | '.join(cell.text.strip() for cell in row.cells)
-                    if row_text.strip():
-                        paragraphs.append(row_text)
-
-            full_text = "\n\n".join(paragraphs)
+            full_text = await asyncio.to_thread(self._read_docx, file_path)
 
             # Estimate page count (rough: 3000 chars per page)
             page_count = max(1, len(full_text) // 3000)
@@ -174,6 +293,100 @@ class DocumentProcessor:
             logger.error(f"DOCX extraction failed: {str(e)}")
             raise
 
+    @staticmethod
+    def _read_docx(file_path: str) -> str:
+        """
+        Read the text of a DOCX file synchronously.
+
+        Streams the main document part with lxml's iterparse instead of
+        building a python-docx object tree, clearing each element once
+        consumed so memory stays bounded on large files. Entities are never
+        resolved, so a crafted document cannot pull in local files. Body
+        paragraphs come first, followed by table rows with cells joined by
+        " | ". Text boxes and mc:Fallback content are skipped, as in
+        python-docx. Unlike python-docx, nested-table text is folded into its
+        outer cell and horizontally merged cells appear once.
+        """
+        paragraphs = []
+        table_rows = []
+        run_text = []
+        cell_paragraphs = []
+        row_cells = []
+        table_depth = 0
+        skip_depth = 0
+
+        with zipfile.ZipFile(file_path) as archive:
+            with archive.open(DocumentProcessor._docx_main_part(archive)) as xml_file:
+                # Uploaded XML is untrusted: never expand entities or fetch
+                # external resources
+                events = etree.iterparse(
+                    xml_file,
+                    events=('start', 'end'),
+                    resolve_entities=False,
+                    no_network=True,
+                    huge_tree=False
+                )
+                for event, elem in events:
+                    tag = elem.tag
+
+                    if event == 'start':
+                        if tag in _DOCX_SKIPPED_TAGS:
+                            skip_depth += 1
+                        elif tag == _W_TBL and not skip_depth:
+                            table_depth += 1
+                        continue
+
+                    if skip_depth:
+                        if tag in _DOCX_SKIPPED_TAGS:
+                            skip_depth -= 1
+                    elif tag == _W_T:
+                        # itertext keeps text after unresolved entity nodes
+                        run_text.extend(elem.itertext())
+                    elif tag == _W_TAB:
+                        run_text.append('\t')
+                    elif tag in _W_BREAKS:
+                        run_text.append('\n')
+                    elif tag == _W_P:
+                        text = ''.join(run_text)
+                        run_text.clear()
+                        if table_depth:
+                            cell_paragraphs.append(text)
+                        else:
+                            paragraphs.append(text.strip())
+                    elif tag == _W_TC and table_depth == 1:
+                        row_cells.append('\n'.join(cell_paragraphs).strip())
+                        cell_paragraphs.clear()
+                    elif tag == _W_TR and table_depth == 1:
+                        table_rows.append(' | '.join(row_cells))
+                        row_cells.clear()
+                    elif tag == _W_TBL:
+                        table_depth -= 1
+
+                    elem.clear()
+
+        return "\n\n".join(filter(None, paragraphs + table_rows))
+
+    @staticmethod
+    def _docx_main_part(archive: zipfile.ZipFile) -> str:
+        """
+        Find the main document part of a DOCX package.
+
+        Follows the officeDocument relationship in _rels/.rels, as
+        python-docx does, since the part is not always word/document.xml.
+        """
+        try:
+            rels_xml = archive.read(_DOCX_PACKAGE_RELS)
+        except KeyError:
+            return _DOCX_DEFAULT_MAIN_PART
+
+        parser = etree.XMLParser(resolve_entities=False, no_network=True, huge_tree=False)
+        for rel in etree.fromstring(rels_xml, parser):
+            if rel.get('Type') in _DOCX_OFFICE_DOCUMENT_TYPES and rel.get('TargetMode') != 'External':
+                # Package-level targets are relative to the package root
+                return posixpath.normpath(rel.get('Target', '')).lstrip('/')
+
+        return _DOCX_DEFAULT_MAIN_PART
+
     async def _extract_from_txt(self, file_path: str) -> Tuple[str, int]:
         """
         Extract text from TXT file.
@@ -185,37 +398,47 @@ class DocumentProcessor:
             Tuple of (extracted text, estimated page count)
         """
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                text = f.read()
+            text = await asyncio.to_thread(self._read_txt, file_path)
 
-            # Estimate page count
-            page_count = max(1, len(text) // 3000)
+            # Estimate page count (rounded up: 3000 chars per page)
+            page_count = (len(text) + 2999) // 3000
 
             logger.info(f"TXT extracted: ~{page_count} pages, {len(text)} characters")
 
             return text, page_count
 
-        except UnicodeDecodeError:
-            # Try with different encoding
-            try:
-                with open(file_path, 'r', encoding='latin-1') as f:
-                    text = f.read()
-                page_count = max(1, len(text) // 3000)
-                return text, page_count
-            except Exception as e:
-                logger.error(f"TXT extraction failed with all encodings: {str(e)}")
-                raise
         except Exception as e:
             logger.error(f"TXT extraction failed: {str(e)}")
             raise
 
-    def _create_chunks(self, text: str, document_id: str) -> List[DocumentChunk]:
+    @staticmethod
+    def _read_txt(file_path: str) -> str:
+        """
+        Read and decode a TXT file synchronously.
+
+        The file is read once and decoded as UTF-8; encoding detection only
+        runs if that fails, falling back to latin-1.
+        """
+        data = Path(file_path).read_bytes()
+        try:
+            return data.decode('utf-8')
+        except UnicodeDecodeError:
+            best_match = from_bytes(data).best()
+            return str(best_match) if best_match else data.decode('latin-1')
+
+    def _create_chunks(
+            self,
+            text: str,
+            document_id: str,
+            page_starts: Optional[List[Tuple[int, int]]] = None
+    ) -> List[DocumentChunk]:
         """
         Split text into overlapping chunks using sliding window.
 
         Args:
             text: Full text to chunk
             document_id: Document identifier
+            page_starts: (char offset, page number) pairs in text order
 
         Returns:
             List of DocumentChunk objects
@@ -223,13 +446,18 @@ class DocumentProcessor:
         Strategy:
         - Split by words (preserves semantic meaning better than chars)
         - Use sliding window with overlap
-        - Extract page numbers from [Page X] markers
+        - Slice chunk text from the original by word offsets (no re-joining)
+        - Assign page numbers from the page the chunk starts on
         - Store position metadata
         """
         chunks = []
-        words = text.split()
+        page_starts = page_starts or []
+        page_offsets = [offset for offset, _ in page_starts]
 
-        if len(words) == 0:
+        word_starts, word_ends = self._word_offsets(text)
+        num_words = len(word_starts)
+
+        if num_words == 0:
             logger.warning(f"No words found in document {document_id}")
             return chunks
 
@@ -244,14 +472,15 @@ class DocumentProcessor:
         start = 0
         chunk_index = 0
 
-        while start < len(words):
+        while start < num_words:
             # Extract chunk
-            end = min(start + chunk_size_words, len(words))
-            chunk_words = words[start:end]
-            chunk_text = " ".join(chunk_words)
+            end = min(start + chunk_size_words, num_words)
+            chunk_start = int(word_starts[start])
+            chunk_text = text[chunk_start:int(word_ends[end - 1])]
 
-            # Extract page number from [Page X] markers
-            page_number = self._extract_page_number(chunk_text)
+            # Page on which the chunk starts
+            page_idx = bisect.bisect_right(page_offsets, chunk_start) - 1
+            page_number = page_starts[page_idx][1] if page_idx >= 0 else None
 
             # Create chunk
             chunk = DocumentChunk(
@@ -261,11 +490,11 @@ class DocumentProcessor:
                 page_number=page_number,
                 chunk_index=chunk_index,
                 metadata={
-                    "word_count": len(chunk_words),
+                    "word_count": end - start,
                     "char_count": len(chunk_text),
                     "start_word": start,
                     "end_word": end,
-                    "is_complete": (end == len(words))
+                    "is_complete": (end == num_words)
                 }
             )
             chunks.append(chunk)
@@ -286,42 +515,77 @@ class DocumentProcessor:
 
         return chunks
 
-    def _extract_page_number(self, text: str) -> Optional[int]:
+    @staticmethod
+    def _word_offsets(text: str) -> Tuple[np.ndarray, np.ndarray]:
         """
-        Extract page number from text containing [Page X] markers.
+        Locate every whitespace-delimited word in text.
+
+        Works on the UTF-32 code points in one vectorized pass, so no
+        per-word Python objects are created and the offsets index the str
+        directly.
 
         Args:
-            text: Text to search
+            text: Full text to tokenize
 
         Returns:
-            Page number if found, None otherwise
+            Tuple of (start offsets, end offsets) as integer arrays
         """
-        match = re.search(r'\[Page (\d+)\]', text)
-        if match:
-            return int(match.group(1))
-        return None
+        code_points = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+        is_word = ~np.isin(code_points, _WHITESPACE_CODEPOINTS)
 
-    def save_uploaded_file(self, file_content: bytes, filename: str) -> str:
+        # +1 where a word begins, -1 just past where it ends
+        edges = np.diff(is_word.astype(np.int8), prepend=0, append=0)
+        return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+    async def save_uploaded_file(
+            self,
+            upload: UploadFile,
+            filename: str,
+            max_size: int
+    ) -> str:
         """
-        Save uploaded file to disk with unique identifier.
+        Stream an uploaded file to disk with unique identifier.
+
+        The upload is copied in `upload_chunk_size` blocks, so the full file
+        is never held in memory and oversized files fail as soon as the limit
+        is crossed.
 
         Args:
-            file_content: Raw file bytes
+            upload: Uploaded file to read from
             filename: Original filename
+            max_size: Maximum allowed size in bytes
 
         Returns:
             Path to saved file
+
+        Raises:
+            FileTooLargeError: If the upload exceeds max_size
         """
         # Generate unique filename
         file_id = str(uuid.uuid4())
         file_extension = Path(filename).suffix
         file_path = self.upload_dir / f"{file_id}{file_extension}"
 
+        # Reject early when the parser already knows the upload size
+        if upload.size is not None and upload.size > max_size:
+            raise FileTooLargeError(f"File too large. Max size: {max_size} bytes")
+
         # Save file
-        with open(file_path, 'wb') as f:
-            f.write(file_content)
+        size = 0
+        try:
+            async with aiofiles.open(file_path, 'wb') as f:
+                while chunk := await upload.read(settings.upload_chunk_size):
+                    size += len(chunk)
+                    if size > max_size:
+                        raise FileTooLargeError(
+                            f"File too large. Max size: {max_size} bytes"
+                        )
+                    await f.write(chunk)
+        except Exception:
+            file_path.unlink(missing_ok=True)
+            raise
 
-        logger.info(f"File saved: {file_path} ({len(file_content)} bytes)")
+        logger.info(f"File saved: {file_path} ({size} bytes)")
 
         return str(file_path)
 
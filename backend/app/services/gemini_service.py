@@ -3,17 +3,220 @@ Google Gemini AI Service with Enhanced Prompting and Batch Processing
 """
 import time
 import logging
-import re
 import asyncio
+import hashlib
+from collections import OrderedDict
 from typing import List, Dict, Any, Optional, Tuple
 
 import google.generativeai as genai
+import numpy as np
 
 from app.config import settings
 from app.models.question import QuestionType, MultipleChoiceOption
 
 logger = logging.getLogger(__name__)
 
+# Answer generation parameters, shared by every request
+_GENERATION_CONFIG = genai.types.GenerationConfig(
+    temperature=0.7,
+    top_p=0.9,
+    top_k=40,
+    max_output_tokens=2048,
+)
+
+# Safety filters are disabled so document content is never blocked
+_SAFETY_SETTINGS = [
+    {
+        "category": "HARM_CATEGORY_HARASSMENT",
+        "threshold": "BLOCK_NONE"
+    },
+    {
+        "category": "HARM_CATEGORY_HATE_SPEECH",
+        "threshold": "BLOCK_NONE"
+    },
+    {
+        "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+        "threshold": "BLOCK_NONE"
+    },
+    {
+        "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
+        "threshold": "BLOCK_NONE"
+    }
+]
+
+# Separator placed between context chunks in the prompt
+_CONTEXT_SEPARATOR = "\n\n" + "=" * 80 + "\n\n"
+
+# Base instructions (common for all question types)
+_BASE_INSTRUCTIONS = """Sen bir belge analiz uzmanısın. Verilen bağlamı kullanarak soruları yanıtla.
+
+⚠️ ÖNEMLİ KURALLAR:
+1. SADECE verilen belge bağlamını kullan - kendi bilgini ekleme
+2. Her iddiada kaynak göster: [Kaynak X] formatında (X = kaynak numarası)
+3. Emin değilsen "Bu bilgi belgede açıkça belirtilmemiş" de
+4. Doğrudan alıntı yaparken çift tırnak kullan: "alıntı metni"
+5. Net, öz ve Türkçe yanıt ver"""
+
+# Per-type prompt templates, assembled once; only {context}, {question} and
+# {options} are filled in per request
+_PROMPT_TEMPLATES = {
+    QuestionType.OPEN_ENDED: _BASE_INSTRUCTIONS + """
+
+📚 BAĞLAM:
+{context}
+
+❓ SORU: {question}
+
+📝 CEVAP FORMATI:
+1. Ana cevabı 2-4 paragraf olarak ver
+2. Her iddia için [Kaynak X] ile kaynak göster
+3. Önemli noktalarda doğrudan alıntı yap: "alıntı"
+4. Sonunda kısa bir özet ekle
+
+CEVAP:""",
+
+    QuestionType.MULTIPLE_CHOICE: _BASE_INSTRUCTIONS + """
+
+📚 BAĞLAM:
+{context}
+
+❓ SORU: {question}
+
+✅ SEÇENEKLER:
+{options}
+
+📝 CEVAP FORMATI:
+1. İlk satırda: "Cevap: [seçenek_id]" formatında doğru cevabı belirt
+2. Seçim gerekçesini açıkla ve [Kaynak X] ile kaynak göster
+3. Diğer seçeneklerin neden yanlış olduğunu kısaca açıkla
+
+CEVAP:""",
+
+    QuestionType.TRUE_FALSE: _BASE_INSTRUCTIONS + """
+
+📚 BAĞLAM:
+{context}
+
+⚖️ İFADE: {question}
+
+📝 CEVAP FORMATI:
+1. İlk satırda sadece "DOĞRU" veya "YANLIŞ" yaz
+2. Gerekçeyi açıkla ve [Kaynak X] ile kaynak göster
+3. Belgeden alıntı yaparak kanıtla: "alıntı metni"
+
+CEVAP:""",
+
+    QuestionType.SHORT_ANSWER: _BASE_INSTRUCTIONS + """
+
+📚 BAĞLAM:
+{context}
+
+❓ SORU: {question}
+
+📝 CEVAP FORMATI:
+Kısa ve öz yanıt ver (maksimum 2-3 cümle), kaynak göster [Kaynak X]
+
+CEVAP:""",
+}
+
+_MC_WITHOUT_OPTIONS_TEMPLATE = _BASE_INSTRUCTIONS + "\n\nSORU: {question}\n\nCEVAP:"
+
+# Fallback for unknown types
+_FALLBACK_PROMPT_TEMPLATE = _BASE_INSTRUCTIONS + "\n\nBĞLAM:\n{context}\n\nSORU: {question}\n\nCEVAP:"
+
+_STEP_BULLETS = frozenset('-•*')
+_STEP_FIRST_CHARS = frozenset('-•*SsAa')
+_STEP_KEYWORDS = ('step', 'adim')
+
+
+def _step_marker_end(line: str) -> int:
+    """
+    Find where a reasoning step marker ends at the start of a stripped line.
+
+    Recognizes "1. ", "2) ", "- ", "• ", "* ", "Step 1:" and "Adım 1:"
+    (keywords case-insensitive, with i/ı/İ treated alike). Most lines are
+    rejected after looking at their first character.
+
+    Returns:
+        Offset just past the marker, or 0 if the line has no marker
+    """
+    if not line:
+        return 0
+
+    first = line[0]
+    length = len(line)
+
+    if first.isdecimal():
+        i = 1
+        while i < length and line[i].isdecimal():
+            i += 1
+        if i + 1 < length and line[i] in '.)' and line[i + 1].isspace():
+            return i + 1
+        return 0
+
+    if first not in _STEP_FIRST_CHARS:
+        return 0
+
+    if first in _STEP_BULLETS:
+        return 1 if length > 1 and line[1].isspace() else 0
+
+    keyword = line[:4].replace('İ', 'i').replace('ı', 'i').lower()
+    if keyword not in _STEP_KEYWORDS:
+        return 0
+
+    i = 4
+    if i >= length or not line[i].isspace():
+        return 0
+    while i < length and line[i].isspace():
+        i += 1
+
+    digits_start = i
+    while i < length and line[i].isdecimal():
+        i += 1
+    if i == digits_start or i >= length or line[i] != ':':
+        return 0
+    return i + 1
+
+
+class _TTLCache:
+    """
+    In-process LRU cache with a per-entry TTL.
+
+    Keys are content hashes of the cached input (embedded text, question and
+    context). All access happens on the event loop without awaiting, so no
+    locking is needed.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+
+    @staticmethod
+    def key(text: str) -> str:
+        """Hash text into a compact cache key."""
+        return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        stored_at, value = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
 
 class GeminiService:
     """
@@ -21,6 +224,7 @@ class GeminiService:
 
     Features:
     - Batch and single embedding generation
+    - Embedding cache for repeated texts
     - Type-aware question answering
     - Reasoning extraction
     - Error handling and retry logic
@@ -30,60 +234,215 @@ class GeminiService:
         genai.configure(api_key=settings.gemini_api_key)
         self.model = genai.GenerativeModel(settings.gemini_model)
         self.embedding_model = settings.gemini_embedding_model
+        self.embedding_dimensions = settings.embedding_dimensions
         self.max_retries = 3
         self.retry_delay = 1.0
+        self._embedding_cache = _TTLCache(
+            maxsize=settings.embedding_cache_size,
+            ttl=settings.embedding_cache_ttl
+        )
+        self._answer_cache = _TTLCache(
+            maxsize=settings.answer_cache_size,
+            ttl=settings.answer_cache_ttl
+        )
+        # Monotonic time of the last successful connection test
+        self._connection_ok_at: Optional[float] = None
+        # Caps in-flight embedding calls across all requests
+        self._embedding_semaphore = asyncio.Semaphore(settings.embedding_concurrency)
         logger.info(f"GeminiService initialized with model: {settings.gemini_model}")
 
-    async def generate_embeddings(self, texts: List[str]) -> List[List[float]]:
+    async def generate_embeddings(self, texts: List[str]) -> np.ndarray:
         """
         Generate embeddings for a list of texts.
 
+        Texts are sent in batches of `embedding_batch_size` per request,
+        longest first so each batch carries a similar amount of text. Batches
+        run concurrently, bounded by `embedding_concurrency`.
+
         Args:
             texts: List of text strings to embed
 
         Returns:
-            List of embedding vectors
+            float32 array of shape (len(texts), embedding_dimensions) with
+            L2-normalized rows; rows of texts that could not be embedded are zero
+        """
+        embeddings = np.zeros((len(texts), self.embedding_dimensions), dtype=np.float32)
+        if not texts:
+            return embeddings
+
+        batch_size = settings.embedding_batch_size
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
+        batches = [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+
+        results = await asyncio.gather(*(
+            self._embed_batch([texts[i] for i in batch]) for batch in batches
+        ))
+
+        # Scatter results back to the caller's order
+        failed = 0
+        for batch, batch_embeddings in zip(batches, results):
+            for i, embedding in zip(batch, batch_embeddings):
+                if embedding is None:
+                    failed += 1
+                else:
+                    embeddings[i] = embedding
+        self._normalize(embeddings)
+
+        if failed:
+            logger.error(f"{failed} of {len(texts)} texts could not be embedded (zero vectors)")
+        logger.info(f"Generated {len(embeddings) - failed} embeddings in {len(batches)} batches")
+        return embeddings
+
+    async def _embed_batch(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """
+        Embed one batch of texts, falling back to one request per text.
+
+        If the batch request still fails after its retries, each text is
+        retried on its own, so a single text the API rejects only loses its
+        own embedding instead of the whole batch.
+
+        Args:
+            texts: Texts to embed (at most `embedding_batch_size`)
+
+        Returns:
+            Embedding vectors aligned with `texts`; None for texts that failed
+        """
+        embeddings = await self._request_embeddings(texts)
+        if embeddings is not None:
+            return embeddings
+        if len(texts) == 1:
+            return [None]
+
+        logger.warning(f"Batch of {len(texts)} texts failed, embedding them individually")
+        singles = await asyncio.gather(*(self._request_embeddings([text]) for text in texts))
+        return [single[0] if single is not None else None for single in singles]
+
+    async def _request_embeddings(self, texts: List[str]) -> Optional[List[List[float]]]:
         """
-        embeddings = []
+        Embed texts in a single request, retrying on failure.
 
-        for i, text in enumerate(texts):
-            for attempt in range(self.max_retries):
-                try:
-                    result = genai.embed_content(
+        Each attempt holds the shared semaphore only while the request is in
+        flight, so retries of one request never hold up the others.
+
+        Args:
+            texts: Texts to embed (at most `embedding_batch_size`)
+
+        Returns:
+            Embedding vectors, or None if every attempt failed
+        """
+        for attempt in range(self.max_retries):
+            try:
+                async with self._embedding_semaphore:
+                    result = await genai.embed_content_async(
                         model=self.embedding_model,
-                        content=text,
-                        task_type="retrieval_document"
+                        content=texts,
+                        task_type="retrieval_document",
+                        output_dimensionality=self.embedding_dimensions
                     )
-                    embeddings.append(result['embedding'])
-                    break
-
-                except Exception as e:
-                    if attempt == self.max_retries - 1:
-                        logger.error(f"Embedding generation failed after {self.max_retries} attempts: {e}")
-                        # Return zero vector as fallback
-                        embeddings.append([0.0] * 768)
-                    else:
-                        logger.warning(f"Embedding attempt {attempt + 1} failed, retrying...")
-                        await asyncio.sleep(self.retry_delay)
+                return result['embedding']
 
-        logger.info(f"Generated {len(embeddings)} embeddings")
-        return embeddings
+            except Exception as e:
+                if attempt == self.max_retries - 1:
+                    logger.error(f"Embedding generation failed after {self.max_retries} attempts: {e}")
+                    return None
+
+                logger.warning(f"Embedding attempt {attempt + 1} failed, retrying...")
+                await asyncio.sleep(self.retry_delay)
 
-    async def generate_embeddings_batch(self, texts: List[str]) -> List[List[float]]:
+    async def generate_embeddings_batch(self, texts: List[str]) -> np.ndarray:
         """
         Batch embedding generation (optimized for multiple texts).
 
+        Alias of `generate_embeddings`, which already batches requests.
+
         Args:
             texts: List of text strings to embed
 
         Returns:
-            List of embedding vectors
+            float32 array of embedding vectors
         """
-        # For now, uses same implementation as generate_embeddings
-        # Can be optimized with parallel processing if needed
         return await self.generate_embeddings(texts)
 
-    async def generate_query_embedding(self, query: str) -> List[float]:
+    async def generate_cached_embeddings(self, texts: List[str]) -> np.ndarray:
+        """
+        Generate embeddings, reusing cached vectors for previously seen texts.
+
+        Duplicate texts within the call are embedded only once and the results
+        are scattered back to every position.
+
+        Args:
+            texts: List of text strings to embed
+
+        Returns:
+            float32 array of embedding vectors aligned with `texts`
+        """
+        keys = [self._embedding_cache.key(text) for text in texts]
+        resolved: Dict[str, np.ndarray] = {}
+        missing: Dict[str, str] = {}
+
+        for key, text in zip(keys, texts):
+            if key in resolved or key in missing:
+                continue
+            cached = self._embedding_cache.get(key)
+            if cached is not None:
+                resolved[key] = self._dequantize(cached)
+            else:
+                missing[key] = text
+
+        if missing:
+            new_embeddings = await self.generate_embeddings_batch(list(missing.values()))
+            for key, embedding in zip(missing, new_embeddings):
+                resolved[key] = embedding
+                # Don't cache zero-vector fallbacks from failed calls
+                if embedding.any():
+                    self._embedding_cache.set(key, self._quantize(embedding))
+
+        logger.info(
+            f"Embeddings resolved: {len(texts)} texts, "
+            f"{len(missing)} embedded, {len(texts) - len(missing)} from cache/duplicates"
+        )
+        embeddings = np.empty((len(texts), self.embedding_dimensions), dtype=np.float32)
+        for i, key in enumerate(keys):
+            embeddings[i] = resolved[key]
+        return embeddings
+
+    @staticmethod
+    def _normalize(embeddings: np.ndarray) -> np.ndarray:
+        """
+        L2-normalize embedding vectors in place, leaving zero vectors as is.
+
+        Unit vectors make inner product equal to cosine similarity, and
+        reduced-dimension Gemini embeddings are not normalized by the API.
+        """
+        norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+        np.divide(embeddings, norms, out=embeddings, where=norms > 0)
+        return embeddings
+
+    @staticmethod
+    def _quantize(embedding: np.ndarray) -> Tuple[np.ndarray, float]:
+        """
+        Quantize an embedding to int8 with a per-vector scale for caching.
+
+        Cuts cached vectors to a quarter of their float32 size; the rounding
+        error (at most scale / 2 per component) is negligible for retrieval.
+
+        Args:
+            embedding: Non-zero embedding vector
+
+        Returns:
+            Tuple of (int8 vector, scale)
+        """
+        embedding = np.asarray(embedding, dtype=np.float32)
+        scale = float(np.abs(embedding).max()) / 127.0
+        return np.round(embedding / scale).astype(np.int8), scale
+
+    @staticmethod
+    def _dequantize(entry: Tuple[np.ndarray, float]) -> np.ndarray:
+        """Restore a float32 embedding from a `_quantize` cache entry."""
+        quantized, scale = entry
+        return quantized.astype(np.float32) * np.float32(scale)
+
+    async def generate_query_embedding(self, query: str) -> np.ndarray:
         """
         Generate embedding for a search query.
 
@@ -91,18 +450,19 @@ class GeminiService:
             query: Search query text
 
         Returns:
-            Embedding vector
+            L2-normalized float32 embedding vector
         """
         try:
-            result = genai.embed_content(
+            result = await genai.embed_content_async(
                 model=self.embedding_model,
                 content=query,
-                task_type="retrieval_query"  # Different task type for queries
+                task_type="retrieval_query",  # Different task type for queries
+                output_dimensionality=self.embedding_dimensions
             )
-            return result['embedding']
+            return self._normalize(np.array(result['embedding'], dtype=np.float32))
         except Exception as e:
             logger.error(f"Query embedding generation failed: {e}")
-            return [0.0] * 768
+            return np.zeros(self.embedding_dimensions, dtype=np.float32)
 
     async def answer_question(
             self,
@@ -112,6 +472,14 @@ class GeminiService:
             options: Optional[List[MultipleChoiceOption]] = None
     ) -> Tuple[str, List[str]]:
         """Answer a question using context with type-specific prompting."""
+        cache_key = self._answer_cache_key(question, question_type, context_chunks, options)
+        cached = self._answer_cache.get(cache_key)
+        if cached is not None:
+            answer, reasoning_steps = cached
+            logger.info(f"Answer served from cache, type: {question_type}")
+            return answer, list(reasoning_steps)
+
+        # Built once per call; every retry sends the same prompt
         prompt = self._build_prompt(question, question_type, context_chunks, options)
 
         for attempt in range(self.max_retries):
@@ -119,32 +487,10 @@ class GeminiService:
                 start_time = time.time()
 
                 # Generate with DISABLED safety settings
-                response = self.model.generate_content(
+                response = await self.model.generate_content_async(
                     prompt,
-                    generation_config=genai.types.GenerationConfig(
-                        temperature=0.7,
-                        top_p=0.9,
-                        top_k=40,
-                        max_output_tokens=2048,
-                    ),
-                    safety_settings=[
-                        {
-                            "category": "HARM_CATEGORY_HARASSMENT",
-                            "threshold": "BLOCK_NONE"
-                        },
-                        {
-                            "category": "HARM_CATEGORY_HATE_SPEECH",
-                            "threshold": "BLOCK_NONE"
-                        },
-                        {
-                            "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                            "threshold": "BLOCK_NONE"
-                        },
-                        {
-                            "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                            "threshold": "BLOCK_NONE"
-                        }
-                    ]
+                    generation_config=_GENERATION_CONFIG,
+                    safety_settings=_SAFETY_SETTINGS
                 )
 
                 elapsed = time.time() - start_time
@@ -172,6 +518,8 @@ class GeminiService:
                     f"length: {len(answer)} chars"
                 )
 
+                # Only successful answers are cached; fallbacks are retried next time
+                self._answer_cache.set(cache_key, (answer, tuple(reasoning_steps)))
                 return answer, reasoning_steps
 
             except AttributeError as e:
@@ -200,6 +548,28 @@ class GeminiService:
 
         return "Yanıt oluşturulamadı.", []
 
+    def _answer_cache_key(
+            self,
+            question: str,
+            question_type: QuestionType,
+            context_chunks: List[Dict],
+            options: Optional[List[MultipleChoiceOption]] = None
+    ) -> str:
+        """
+        Build the answer cache key for a question and its context.
+
+        Chunk IDs keep their order because the prompt cites sources by
+        position ([Kaynak N]).
+        """
+        parts = [
+            question_type.value,
+            ' '.join(question.split()).lower(),
+            *(chunk['chunk_id'] for chunk in context_chunks)
+        ]
+        if options:
+            parts.extend(f"{option.id}:{option.text}" for option in options)
+        return self._answer_cache.key('\x1f'.join(parts))
+
     def _build_prompt(
         self,
         question: str,
@@ -208,88 +578,17 @@ class GeminiService:
         options: Optional[List[MultipleChoiceOption]] = None
     ) -> str:
         """Build type-specific prompt with enhanced instructions."""
+        if question_type == QuestionType.MULTIPLE_CHOICE and not options:
+            return _MC_WITHOUT_OPTIONS_TEMPLATE.format(question=question)
 
-        # Build context from chunks
-        context = self._format_context(chunks)
+        template = _PROMPT_TEMPLATES.get(question_type, _FALLBACK_PROMPT_TEMPLATE)
+        options_text = "\n".join(f"{opt.id}. {opt.text}" for opt in options) if options else ""
 
-        # Base instructions (common for all types)
-        base_instructions = """Sen bir belge analiz uzmanısın. Verilen bağlamı kullanarak soruları yanıtla.
-
-⚠️ ÖNEMLİ KURALLAR:
-1. SADECE verilen belge bağlamını kullan - kendi bilgini ekleme
-2. Her iddiada kaynak göster: [Kaynak X] formatında (X = kaynak numarası)
-3. Emin değilsen "Bu bilgi belgede açıkça belirtilmemiş" de
-4. Doğrudan alıntı yaparken çift tırnak kullan: "alıntı metni"
-5. Net, öz ve Türkçe yanıt ver"""
-
-        if question_type == QuestionType.OPEN_ENDED:
-            return f"""{base_instructions}
-
-📚 BAĞLAM:
-{context}
-
-❓ SORU: {question}
-
-📝 CEVAP FORMATI:
-1. Ana cevabı 2-4 paragraf olarak ver
-2. Her iddia için [Kaynak X] ile kaynak göster
-3. Önemli noktalarda doğrudan alıntı yap: "alıntı"
-4. Sonunda kısa bir özet ekle
-
-CEVAP:"""
-
-        elif question_type == QuestionType.MULTIPLE_CHOICE:
-            if not options:
-                return f"{base_instructions}\n\nSORU: {question}\n\nCEVAP:"
-
-            options_text = "\n".join([f"{opt.id}. {opt.text}" for opt in options])
-            return f"""{base_instructions}
-
-📚 BAĞLAM:
-{context}
-
-❓ SORU: {question}
-
-✅ SEÇENEKLER:
-{options_text}
-
-📝 CEVAP FORMATI:
-1. İlk satırda: "Cevap: [seçenek_id]" formatında doğru cevabı belirt
-2. Seçim gerekçesini açıkla ve [Kaynak X] ile kaynak göster
-3. Diğer seçeneklerin neden yanlış olduğunu kısaca açıkla
-
-CEVAP:"""
-
-        elif question_type == QuestionType.TRUE_FALSE:
-            return f"""{base_instructions}
-
-📚 BAĞLAM:
-{context}
-
-⚖️ İFADE: {question}
-
-📝 CEVAP FORMATI:
-1. İlk satırda sadece "DOĞRU" veya "YANLIŞ" yaz
-2. Gerekçeyi açıkla ve [Kaynak X] ile kaynak göster
-3. Belgeden alıntı yaparak kanıtla: "alıntı metni"
-
-CEVAP:"""
-
-        elif question_type == QuestionType.SHORT_ANSWER:
-            return f"""{base_instructions}
-
-📚 BAĞLAM:
-{context}
-
-❓ SORU: {question}
-
-📝 CEVAP FORMATI:
-Kısa ve öz yanıt ver (maksimum 2-3 cümle), kaynak göster [Kaynak X]
-
-CEVAP:"""
-
-        # Fallback for unknown types
-        return f"{base_instructions}\n\nBĞLAM:\n{context}\n\nSORU: {question}\n\nCEVAP:"
+        return template.format(
+            context=self._format_context(chunks),
+            question=question,
+            options=options_text
+        )
 
     def _format_context(self, chunks: List[Dict]) -> str:
         """
@@ -301,18 +600,12 @@ CEVAP:"""
         Returns:
             Formatted context string
         """
-        context_parts = []
-
-        for i, chunk in enumerate(chunks, 1):
-            text = chunk.get('text', '')
-            page = chunk.get('page_number', 'N/A')
-            relevance = chunk.get('relevance_score', 0.0)
-
-            # Add source marker with metadata
-            header = f"[Kaynak {i}] (Sayfa {page}, İlgililik: {relevance:.0%})"
-            context_parts.append(f"{header}:\n{text}")
-
-        return "\n\n" + "="*80 + "\n\n".join(context_parts)
+        # Source marker with metadata, then the chunk text
+        return _CONTEXT_SEPARATOR.join(
+            f"[Kaynak {i}] (Sayfa {chunk.get('page_number', 'N/A')}, "
+            f"İlgililik: {chunk.get('relevance_score', 0.0):.0%}):\n{chunk.get('text', '')}"
+            for i, chunk in enumerate(chunks, 1)
+        )
 
     def _extract_reasoning_steps(self, answer: str) -> List[str]:
         """
@@ -332,12 +625,10 @@ CEVAP:"""
         for line in lines:
             line = line.strip()
 
-            # Match various list formats:
-            # "1. ", "2) ", "- ", "• ", "* ", "Step 1:", "Adım 1:"
-            if re.match(r'^(\d+[\.)]\s+|[-•*]\s+|(?:Step|Adım)\s+\d+:)', line, re.IGNORECASE):
-                # Remove the marker
-                step = re.sub(r'^(\d+[\.)]\s+|[-•*]\s+|(?:Step|Adım)\s+\d+:)', '', line, flags=re.IGNORECASE)
-                step = step.strip()
+            # Match numbered, bulleted and "Step N:" list formats
+            marker_end = _step_marker_end(line)
+            if marker_end:
+                step = line[marker_end:].strip()
 
                 # Only include meaningful steps (> 15 chars)
                 if len(step) > 15:
@@ -346,19 +637,30 @@ CEVAP:"""
         # Return max 5 steps
         return steps[:5]
 
-    def test_connection(self) -> bool:
+    async def test_connection(self) -> bool:
         """
         Test if Gemini API connection is working.
 
+        Also opens the SDK's async client on the running event loop. A
+        success is remembered for `connection_check_ttl` seconds, so frequent
+        readiness probes don't each cost an API call.
+
         Returns:
             True if connection successful
         """
+        if (
+            self._connection_ok_at is not None
+            and time.monotonic() - self._connection_ok_at < settings.connection_check_ttl
+        ):
+            return True
+
         try:
-            test_result = genai.embed_content(
+            test_result = await genai.embed_content_async(
                 model=self.embedding_model,
                 content="test",
                 task_type="retrieval_document"
             )
+            self._connection_ok_at = time.monotonic()
             logger.info("Gemini API connection test successful")
             return True
         except Exception as e:
@@ -1,9 +1,14 @@
 """
 ChromaDB Vector Store Service
 """
+import time
 import logging
-from typing import List, Dict, Any, Optional
+import sqlite3
+import threading
+from pathlib import Path
+from typing import List, Dict, Any, Optional, Set, Tuple
 import chromadb
+import numpy as np
 
 from app.config import settings
 from app.models.document import DocumentChunk
@@ -17,7 +22,7 @@ class VectorStoreService:
 
     Features:
     - Document chunk storage with embeddings
-    - Similarity search
+    - HNSW approximate nearest neighbour search
     - Metadata filtering
     - Collection statistics
     """
@@ -28,34 +33,107 @@ class VectorStoreService:
             self.client = chromadb.PersistentClient(
                 path=settings.chroma_persist_directory
             )
+            if settings.chroma_sqlite_wal:
+                self._enable_sqlite_wal()
 
             # Get or create collection
             self.collection = self.client.get_or_create_collection(
                 name=settings.chroma_collection_name,
-                metadata={"description": "Document chunks for RAG"}
+                metadata=self._collection_metadata()
             )
 
+            # (timestamp, documents) cache for list_documents
+            self._documents_cache: Optional[Tuple[float, List[Dict[str, Any]]]] = None
+            # Bumped on every invalidation so a listing scanned before a write
+            # is not cached after it
+            self._documents_generation = 0
+            self._documents_cache_lock = threading.Lock()
+            # Stored document IDs, loaded on first use and kept in sync on writes
+            self._doc_ids: Optional[Set[str]] = None
+            # Routes call this service from worker threads; guards _doc_ids
+            self._doc_ids_lock = threading.Lock()
+
             logger.info(
                 f"VectorStoreService initialized: "
                 f"collection='{settings.chroma_collection_name}', "
-                f"path='{settings.chroma_persist_directory}'"
+                f"path='{settings.chroma_persist_directory}', "
+                f"space='{self._distance_space}'"
             )
 
         except Exception as e:
             logger.error(f"Failed to initialize VectorStoreService: {e}")
             raise
 
+    def _invalidate_documents_cache(self) -> None:
+        """Drop the cached document listing after a write."""
+        with self._documents_cache_lock:
+            self._documents_generation += 1
+            self._documents_cache = None
+
+    @staticmethod
+    def _enable_sqlite_wal() -> None:
+        """
+        Switch ChromaDB's SQLite database to write-ahead logging.
+
+        WAL lets searches read while an upload is writing instead of waiting
+        on the writer lock. The journal mode is stored in the database file,
+        so setting it once here applies to every connection ChromaDB opens.
+        Failure is logged and ignored; the default journal still works.
+        """
+        db_file = Path(settings.chroma_persist_directory) / "chroma.sqlite3"
+        try:
+            with sqlite3.connect(db_file, timeout=10) as conn:
+                mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+            conn.close()
+            logger.info(f"ChromaDB SQLite journal mode: {mode}")
+        except sqlite3.Error as e:
+            logger.warning(f"Could not enable WAL for {db_file}: {e}")
+
+    @staticmethod
+    def _collection_metadata() -> Dict[str, Any]:
+        """
+        Build collection metadata including HNSW index parameters.
+
+        ChromaDB only honours these when the collection is created; existing
+        collections keep the parameters they were built with.
+        """
+        return {
+            "description": "Document chunks for RAG",
+            "hnsw:space": settings.chroma_hnsw_space,
+            "hnsw:M": settings.chroma_hnsw_m,
+            "hnsw:construction_ef": settings.chroma_hnsw_construction_ef,
+            "hnsw:search_ef": settings.chroma_hnsw_search_ef
+        }
+
+    @property
+    def _distance_space(self) -> str:
+        """Distance function of the current collection (ChromaDB defaults to L2)."""
+        metadata = self.collection.metadata or {}
+        return metadata.get("hnsw:space", "l2")
+
+    def _distances_to_scores(self, distances: np.ndarray) -> np.ndarray:
+        """
+        Convert ChromaDB distances to 0-1 relevance scores.
+
+        Cosine and inner-product distances are `1 - similarity`, so the
+        similarity is recovered directly. L2 distances are mapped with
+        `1 / (1 + distance)`.
+        """
+        if self._distance_space in ("cosine", "ip"):
+            return np.maximum(0.0, 1.0 - distances)
+        return 1.0 / (1.0 + distances)
+
     def add_chunks(
         self,
         chunks: List[DocumentChunk],
-        embeddings: List[List[float]]
+        embeddings: np.ndarray
     ) -> bool:
         """
         Add document chunks with embeddings to vector store.
 
         Args:
             chunks: List of DocumentChunk objects
-            embeddings: Corresponding embedding vectors
+            embeddings: Corresponding float32 embedding vectors, one row per chunk
 
         Returns:
             True if successful
@@ -67,39 +145,61 @@ class VectorStoreService:
             logger.warning("No chunks to add")
             return False
 
+        # Prepare data for ChromaDB in a single pass
+        ids = []
+        documents = []
+        metadatas = []
+
+        for chunk in chunks:
+            ids.append(chunk.chunk_id)
+            documents.append(chunk.text)
+            metadatas.append({
+                'document_id': chunk.document_id,
+                'chunk_index': chunk.chunk_index,
+                'page_number': chunk.page_number or 0,
+                **chunk.metadata
+            })
+
+        # Add in bounded batches to keep each SQLite write transaction small
+        batch_size = settings.chroma_add_batch_size
+        added = 0
+
         try:
-            # Prepare data for ChromaDB
-            ids = [chunk.chunk_id for chunk in chunks]
-            documents = [chunk.text for chunk in chunks]
-            metadatas = []
-
-            for chunk in chunks:
-                metadata = {
-                    'document_id': chunk.document_id,
-                    'chunk_index': chunk.chunk_index,
-                    'page_number': chunk.page_number or 0,
-                    **chunk.metadata
-                }
-                metadatas.append(metadata)
-
-            # Add to collection
-            self.collection.add(
-                ids=ids,
-                embeddings=embeddings,
-                documents=documents,
-                metadatas=metadatas
-            )
+            for start in range(0, len(ids), batch_size):
+                end = start + batch_size
+                self.collection.add(
+                    ids=ids[start:end],
+                    embeddings=embeddings[start:end],
+                    documents=documents[start:end],
+                    metadatas=metadatas[start:end]
+                )
+                added = min(end, len(ids))
+
+            # Invalidate only once every batch is written, so a listing taken
+            # mid-insert is not what stays cached
+            self._invalidate_documents_cache()
+            with self._doc_ids_lock:
+                if self._doc_ids is not None:
+                    self._doc_ids.update(chunk.document_id for chunk in chunks)
 
             logger.info(f"Added {len(chunks)} chunks to ChromaDB")
             return True
 
         except Exception as e:
             logger.error(f"Failed to add chunks: {e}")
+            # Chroma has no cross-call transaction, so undo earlier batches
+            if added:
+                try:
+                    self.collection.delete(ids=ids[:added])
+                except Exception as cleanup_error:
+                    logger.error(f"Failed to roll back {added} added chunks: {cleanup_error}")
+                # A listing cached mid-insert may include the rolled-back chunks
+                self._invalidate_documents_cache()
             raise
 
     def search(
         self,
-        query_embedding: List[float],
+        query_embedding: np.ndarray,
         n_results: int = 5,
         document_ids: Optional[List[str]] = None,
         min_score: float = 0.0
@@ -136,27 +236,27 @@ class VectorStoreService:
                 logger.info("No search results found")
                 return formatted_results
 
-            for i, chunk_id in enumerate(results['ids'][0]):
-                distance = results['distances'][0][i]
-                metadata = results['metadatas'][0][i]
-                document = results['documents'][0][i]
-
-                # Convert distance to similarity score (lower distance = higher similarity)
-                # ChromaDB uses L2 distance, convert to 0-1 score
-                relevance_score = 1 / (1 + distance)
+            ids = results['ids'][0]
+            metadatas = results['metadatas'][0]
+            documents = results['documents'][0]
+            distances = np.asarray(results['distances'][0], dtype=np.float64)
 
-                # Apply min_score filter
-                if relevance_score < min_score:
-                    continue
+            # Convert distances to similarity scores (lower distance = higher
+            # similarity), apply the min_score filter and rank best first
+            scores = self._distances_to_scores(distances)
+            kept = np.flatnonzero(scores >= min_score)
+            kept = kept[np.argsort(-scores[kept], kind='stable')]
 
+            for i in kept.tolist():
+                metadata = metadatas[i]
                 result = {
-                    'chunk_id': chunk_id,
+                    'chunk_id': ids[i],
                     'document_id': metadata.get('document_id', ''),
-                    'text': document,
+                    'text': documents[i],
                     'page_number': metadata.get('page_number'),
                     'chunk_index': metadata.get('chunk_index', 0),
-                    'relevance_score': relevance_score,
-                    'distance': distance,
+                    'relevance_score': float(scores[i]),
+                    'distance': float(distances[i]),
                     'metadata': metadata
                 }
                 formatted_results.append(result)
@@ -179,25 +279,91 @@ class VectorStoreService:
             True if successful
         """
         try:
-            # Get all chunk IDs for this document
-            results = self.collection.get(
-                where={"document_id": document_id}
-            )
-
-            if not results['ids']:
+            # Existence is decided by the document itself; collection counts
+            # can move with concurrent uploads and are only used for logging
+            where_filter = {"document_id": document_id}
+            existing = self.collection.get(where=where_filter, include=[], limit=1)
+            if not existing['ids']:
                 logger.warning(f"No chunks found for document {document_id}")
                 return False
 
-            # Delete chunks
-            self.collection.delete(ids=results['ids'])
+            count_before = self.collection.count()
+            self.collection.delete(where=where_filter)
+            deleted = count_before - self.collection.count()
 
-            logger.info(f"Deleted {len(results['ids'])} chunks for document {document_id}")
+            self._invalidate_documents_cache()
+            with self._doc_ids_lock:
+                if self._doc_ids is not None:
+                    self._doc_ids.discard(document_id)
+
+            logger.info(f"Deleted chunks for document {document_id} (collection size change: {deleted})")
             return True
 
         except Exception as e:
             logger.error(f"Failed to delete chunks for document {document_id}: {e}")
             raise
 
+    def list_documents(self) -> List[Dict[str, Any]]:
+        """
+        List stored documents with their chunk counts.
+
+        Only chunk metadata is fetched from ChromaDB. The result is cached for
+        `document_list_cache_ttl` seconds and invalidated on writes.
+
+        Returns:
+            List of document summaries
+        """
+        now = time.monotonic()
+        with self._documents_cache_lock:
+            cached = self._documents_cache
+            generation = self._documents_generation
+        if cached is not None and now - cached[0] < settings.document_list_cache_ttl:
+            return cached[1]
+
+        results = self.collection.get(include=["metadatas"])
+
+        docs = {}
+        for metadata in results['metadatas'] or []:
+            doc_id = metadata.get('document_id')
+            if not doc_id:
+                continue
+            if doc_id not in docs:
+                docs[doc_id] = {
+                    'document_id': doc_id,
+                    'chunk_count': 0,
+                    'first_seen': metadata.get('upload_date', 'Unknown')
+                }
+            docs[doc_id]['chunk_count'] += 1
+
+        documents = list(docs.values())
+        with self._documents_cache_lock:
+            # A write finished during the scan; leave the cache empty
+            if generation == self._documents_generation:
+                self._documents_cache = (now, documents)
+        return documents
+
+    def _document_ids(self) -> Set[str]:
+        """
+        Get the IDs of all stored documents.
+
+        The first call scans chunk metadata once; afterwards the set is kept
+        up to date by add_chunks, delete_by_document_id and clear_collection.
+        The scan runs under the lock, so a concurrent add either lands before
+        it and is scanned, or waits and updates the loaded set.
+
+        Returns:
+            Snapshot of the stored document IDs
+        """
+        with self._doc_ids_lock:
+            if self._doc_ids is None:
+                results = self.collection.get(include=["metadatas"])
+                self._doc_ids = {
+                    metadata['document_id']
+                    for metadata in results['metadatas'] or []
+                    if metadata.get('document_id')
+                }
+            return set(self._doc_ids)
+
     def get_collection_stats(self) -> Dict[str, Any]:
         """
         Get statistics about the collection.
@@ -206,20 +372,9 @@ class VectorStoreService:
             Dictionary with stats
         """
         try:
-            count = self.collection.count()
-
-            # Get unique document IDs
-            all_data = self.collection.get()
-            unique_docs = set()
-            if all_data['metadatas']:
-                for metadata in all_data['metadatas']:
-                    doc_id = metadata.get('document_id')
-                    if doc_id:
-                        unique_docs.add(doc_id)
-
             stats = {
-                'total_chunks': count,
-                'total_documents': len(unique_docs),
+                'total_chunks': self.collection.count(),
+                'total_documents': len(self._document_ids()),
                 'collection_name': self.collection.name
             }
 
@@ -246,8 +401,11 @@ class VectorStoreService:
             self.client.delete_collection(name=settings.chroma_collection_name)
             self.collection = self.client.create_collection(
                 name=settings.chroma_collection_name,
-                metadata={"description": "Document chunks for RAG"}
+                metadata=self._collection_metadata()
             )
+            self._invalidate_documents_cache()
+            with self._doc_ids_lock:
+                self._doc_ids = set()
 
             logger.warning("Collection cleared - all data deleted!")
             return True